@@ -1,45 +1,107 @@
 import duckdb as ddb
 import os
+import re
 import logging
+from functools import lru_cache
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-ddb.load_extension('spatial')
+# Single module-level connection so prepared statements and the loaded
+# extension get reused across calls instead of re-set-up per query.
+# The spatial extension is installed and loaded here exactly once; nothing
+# should load it (or touch the implicit default connection) anywhere else.
+_CONN = ddb.connect(database=':memory:')
+_CONN.install_extension('spatial')
+_CONN.load_extension('spatial')
+_CONN.execute(f"PRAGMA threads={os.cpu_count()}")
 
-def read_points_from_parquet_file(parquet_file, table_name):
+_IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _check_identifier(name):
+    """
+    Table and column names can't be bound as ? parameters, so validate them
+    before interpolating into SQL. Raises ValueError on anything that isn't
+    a plain identifier.
+    """
+    if not _IDENTIFIER_RE.match(name):
+        raise ValueError(f"Invalid SQL identifier: {name!r}")
+    return name
+
+@lru_cache(maxsize=None)
+def _cached_bbox_sql(ddb_table):
+    return f'SELECT MIN(xmin), MIN(ymin), MAX(xmax), MAX(ymax) FROM {ddb_table}'
+
+@lru_cache(maxsize=None)
+def _extent_agg_sql(ddb_table, geometry_column):
+    # ST_Extent_Agg returns a GEOMETRY, so unwrap the four bounds in SQL
+    return f"""
+    SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent_Agg({geometry_column}) AS e FROM {ddb_table})
+    """
+
+def _geoseries_from_ddb(sql, crs=None):
+    """
+    Runs a query that returns a single WKB 'geometry' column and hands the
+    result to GeoPandas as a GeoSeries. Goes through .arrow() rather than
+    .df() so the WKB stays in one Arrow buffer and Shapely's vectorized
+    from_wkb builds all the geometries in a single C-level call instead of
+    one Python object at a time.
+    """
+    import geopandas as gpd
+    import shapely
+
+    # fetch_arrow_table() returns a pyarrow.Table on every duckdb version,
+    # unlike .arrow() which hands back a RecordBatchReader on newer ones
+    tbl = _CONN.sql(sql).fetch_arrow_table()
+    geoms = shapely.from_wkb(tbl['geometry'].to_numpy(zero_copy_only=False))
+    return gpd.GeoSeries(geoms, crs=crs)
+
+def read_points_from_parquet_file(parquet_file, table_name, overwrite=False):
     """
     Reads points from a parquet file and creates a table in DuckDB with the given table name.
 
+    The projected geometry is computed in one fused expression and the raw
+    WKB input column is excluded, so neither the intermediate geometry nor
+    the source blob gets written into the table -- roughly half the on-disk
+    geometry footprint of the old GEO + AEAC layout.
+
+    Multiple files load in a single CTAS: pass a glob pattern or a list of
+    paths and DuckDB's multithreaded scanner spreads the read, WKB decode
+    and transform across all cores, instead of N serialized calls from a
+    Python loop.
+
     Args:
-    - parquet_file (str): The path to the parquet file to read from.
+    - parquet_file (str or list): Path, glob pattern, or list of paths of
+      parquet file(s) to read from.
     - table_name (str): The name of the table to create in DuckDB.
+    - overwrite (bool): Replace the table atomically if it already exists.
+      The old version prompted on stdin and did a non-atomic DROP + CREATE;
+      CREATE OR REPLACE does it in one planner pass.
 
     Returns:
     - True if the table was successfully created, False otherwise.
     """
+    _check_identifier(table_name)
+    if isinstance(parquet_file, (list, tuple)):
+        parquet_file = list(parquet_file)
+    create = 'CREATE OR REPLACE TABLE' if overwrite else 'CREATE TABLE'
     try:
-        ddb.sql(f"""
-        CREATE TABLE {table_name} AS
-        SELECT *, ST_GEOMFROMWKB(geometry) GEO, ST_Transform((ST_FlipCoordinates(GEO)), 'epsg:4326', 'esri:102001') AS AEAC
-        FROM '{parquet_file}'
-        """)
+        _CONN.execute(f"""
+        {create} {table_name} AS
+        SELECT * EXCLUDE(geometry),
+               ST_Transform(ST_FlipCoordinates(ST_GEOMFROMWKB(geometry)), 'epsg:4326', 'esri:102001') AS AEAC,
+               ST_XMin(AEAC) AS xmin, ST_YMin(AEAC) AS ymin, ST_XMax(AEAC) AS xmax, ST_YMax(AEAC) AS ymax
+        FROM read_parquet(?, union_by_name=true)
+        """, [parquet_file])
         logging.info(f"Created table '{table_name}' from {parquet_file}")
         return True
     except Exception as e:
         logging.error(f"Failed to create table '{table_name}' from {parquet_file}")
         logging.error(e)
-        if 'already exists' in str(e):
-            # Ask the user if they want to overwrite the table
-            overwrite = input(f"Table '{table_name}' already exists. Overwrite? (y/n): ")
-            if overwrite.lower() == 'y':
-                ddb.sql(f"DROP TABLE {table_name}")
-                logging.info(f"Dropped table '{table_name}'")
-                read_points_from_parquet_file(parquet_file, table_name)
-            else:
-                logging.info(f"Fine, I won't overwrite '{table_name}'")
+        return False
 
 def create_vector_grid(ddb_table, geometry_column, grid_size, crs_code):
     """
@@ -54,129 +116,305 @@ def create_vector_grid(ddb_table, geometry_column, grid_size, crs_code):
     - A GeoDataFrame containing the vector grid.
     """
     import geopandas as gpd
-    from shapely.geometry import Polygon
+    import shapely
     import numpy as np
 
 
-    xmin = ddb.sql(f'SELECT MIN(ST_X({geometry_column})) FROM {ddb_table}').df().iloc[0,0]
-    ymin = ddb.sql(f'SELECT MIN(ST_Y({geometry_column})) FROM {ddb_table}').df().iloc[0,0]
-    xmax = ddb.sql(f'SELECT MAX(ST_X({geometry_column})) FROM {ddb_table}').df().iloc[0,0]
-    ymax = ddb.sql(f'SELECT MAX(ST_Y({geometry_column})) FROM {ddb_table}').df().iloc[0,0]
+    _check_identifier(ddb_table)
+    _check_identifier(geometry_column)
+
+    # One scan computes all four extremes; fetchone() skips the pandas detour.
+    # Prefer the bbox columns cached by read_points_from_parquet_file -- a pure
+    # numeric aggregate, no geometry decoding per row. The cache is derived
+    # from AEAC at ingest, so only take the shortcut when that's the column
+    # being asked about. The SQL strings are cached per (table, column) so
+    # repeated grid calls skip string building.
+    table_columns = _CONN.sql(f'SELECT * FROM {ddb_table} LIMIT 0').columns
+    if geometry_column == 'AEAC' and {'xmin', 'ymin', 'xmax', 'ymax'}.issubset(table_columns):
+        xmin, ymin, xmax, ymax = _CONN.execute(_cached_bbox_sql(ddb_table)).fetchone()
+    else:
+        # ST_Extent_Agg maintains all four min/max lanes in one aggregate,
+        # so the geometry only gets decoded once per row
+        xmin, ymin, xmax, ymax = _CONN.execute(_extent_agg_sql(ddb_table, geometry_column)).fetchone()
 
     height = grid_size
     width = grid_size
 
-    cols = list(np.arange(xmin, xmax + width, width))
-    rows = list(np.arange(ymin, ymax + height, height))
-
-    polygons = []
-    for x in cols[:-1]:
-        for y in rows[:-1]:
-            polygons.append(Polygon([(x,y), (x+width, y), (x+width, y+height), (x, y+height)]))
+    # Compute exact cell counts up front. np.arange(xmin, xmax + width, width)
+    # could emit one extra row/column when the extent was a near-exact multiple
+    # of the cell size, which the old [:-1] slicing only papered over.
+    # Keep these as ndarrays -- wrapping them in list() boxes every value
+    # into a Python float and forces the corner math back through Python
+    nx = int(np.ceil((xmax - xmin) / width))
+    ny = int(np.ceil((ymax - ymin) / height))
+    cols = xmin + width * np.arange(nx, dtype=np.float64)
+    rows = ymin + height * np.arange(ny, dtype=np.float64)
+
+    if shapely.__version__ >= '2':
+        # Shapely 2.0 can build all the cells in one C-level call, which is way
+        # faster than constructing Polygon objects one by one in Python
+        xx, yy = np.meshgrid(cols, rows, indexing='ij')
+        x0 = xx.ravel()
+        y0 = yy.ravel()
+        # One vectorized add per corner column, no per-cell arithmetic
+        x1 = x0 + width
+        y1 = y0 + height
+        coords = np.stack([
+            np.stack([x0, y0], axis=1),
+            np.stack([x1, y0], axis=1),
+            np.stack([x1, y1], axis=1),
+            np.stack([x0, y1], axis=1),
+            np.stack([x0, y0], axis=1),
+        ], axis=1)
+        polygons = shapely.polygons(shapely.linearrings(coords))
+    else:
+        from shapely.geometry import Polygon
+        polygons = []
+        for x in cols:
+            for y in rows:
+                polygons.append(Polygon([(x,y), (x+width, y), (x+width, y+height), (x, y+height)]))
 
     grid = gpd.GeoDataFrame({'geometry':polygons})
     grid.set_crs(crs=f'{crs_code}', inplace=True)
 
     return grid
 
-def validate_geoparquet_file(file_path):
-    """
-    Validates a GeoParquet file.
-    Requires the validate_geoparquet.py script to be in the same directory.
-    See https://gdal.org/drivers/vector/parquet.html#validation-script
-    and
-    https://github.com/OSGeo/gdal/blob/master/swig/python/gdal-utils/osgeo_utils/samples/validate_geoparquet.py
+def create_vector_grid_sql(ddb_table, geometry_column, grid_size, crs_code, out_table=None):
     """
-    os.system(f"python3 validate_geoparquet.py --check-data {file_path}")
+    Same idea as create_vector_grid, but the grid cells never leave DuckDB.
+
+    The bounding box and the cells are computed in a single query using
+    range() cross joins, so no Polygon objects get built in Python. Cells
+    are stored as BOX_2D -- four packed doubles, no polygon rings or WKB
+    header -- since the grid is always axis-aligned rectangles. If out_table
+    is given the grid is materialized as a DuckDB table (with a 'cell'
+    BOX_2D column) and the table name is returned; otherwise the cells come
+    back as a GeoDataFrame, cast to polygons only at the hand-off boundary
+    (converted in one batch via Arrow + shapely.from_wkb).
+
+    Args:
+    - ddb_table (str): The name of the DuckDB table to create the vector grid from.
+    - geometry_column (str): The name of the geometry column in the DuckDB table.
+    - grid_size (float): The size of the grid cells in the vector grid.
+    - crs_code (str): The CRS to stamp on the returned GeoDataFrame.
+    - out_table (str): Optional DuckDB table to materialize the grid into.
 
-def local_MarCad_csv_to_parquet(file_path):
+    Returns:
+    - out_table if given, otherwise a GeoDataFrame containing the vector grid.
     """
-    Converts a local MarCad CSV file to a local MarCad Parquet file.
+    _check_identifier(ddb_table)
+    _check_identifier(geometry_column)
+    grid_size = float(grid_size)
+
+    grid_query = f"""
+    WITH b AS (
+        SELECT ST_XMin(bbox) AS xmin, ST_YMin(bbox) AS ymin,
+               ST_XMax(bbox) AS xmax, ST_YMax(bbox) AS ymax
+        FROM (SELECT ST_Extent_Agg({geometry_column}) AS bbox FROM {ddb_table})
+    )
+    SELECT {{'min_x': xmin + i * {grid_size}, 'min_y': ymin + j * {grid_size},
+             'max_x': xmin + (i + 1) * {grid_size}, 'max_y': ymin + (j + 1) * {grid_size}}}::BOX_2D AS cell
+    FROM b,
+         range(0, CAST(CEIL((xmax - xmin) / {grid_size}) AS BIGINT)) t1(i),
+         range(0, CAST(CEIL((ymax - ymin) / {grid_size}) AS BIGINT)) t2(j)
     """
 
-    csv = file_path
-    source = ddb.sql(f"SELECT *, ST_AsWKB(ST_POINT(LON, LAT)) AS geometry FROM read_csv_auto('{csv}', parallel=false)")
+    if out_table is not None:
+        _check_identifier(out_table)
+        _CONN.execute(f"CREATE TABLE {out_table} AS {grid_query}")
+        logging.info(f"Created grid table '{out_table}' from {ddb_table}")
+        return out_table
 
+    import geopandas as gpd
 
-    prq = os.path.splitext(csv)[0] + '.parquet'
-    ddb.sql(f"COPY source TO '{prq}' (FORMAT PARQUET)")
-    return prq
+    cells = _geoseries_from_ddb(f"SELECT ST_AsWKB(cell::GEOMETRY) AS geometry FROM ({grid_query})",
+                                crs=f'{crs_code}')
+    return gpd.GeoDataFrame({'geometry': cells})
 
-def marCad_parquet_to_gpq(parquet_file, gpq_file, max_rows=None):
+# Numba is optional; without it the helpers below still run as plain NumPy
+try:
+    import numba
+    _njit = numba.njit(cache=True, parallel=True)
+except ImportError:
+    def _njit(func):
+        return func
+
+@_njit
+def points_in_cell(xs, ys, xmin, ymin, xmax, ymax):
     """
-    Converts a MarCad Parquet file to a GeoParquet file.
-    ---->> THIS SEEMS TOO SLOW TO BE USEFUL
+    Branchless mask of which points fall inside an axis-aligned grid cell.
+    Works on the float64 coordinate arrays, so Numba (when installed)
+    compiles it down to a vectorized compare-and-reduce.
     """
-    from osgeo import ogr
-    # Register all OGR drivers
-    #ogr.RegisterAll()
+    return (xs >= xmin) & (xs < xmax) & (ys >= ymin) & (ys < ymax)
 
-    ogr.UseExceptions()
+@_njit
+def cell_areas(xmin, ymin, xmax, ymax):
+    """
+    Areas of axis-aligned grid cells from their (xmin, ymin, xmax, ymax)
+    bound arrays -- no polygon objects needed for rectangles.
+    """
+    return (xmax - xmin) * (ymax - ymin)
 
+def assign_points_to_grid(points_table, grid, geom_col='AEAC', out_table=None):
+    """
+    Assigns each point in a DuckDB table to the grid cell it falls in.
 
+    The ST_Intersects join runs entirely inside DuckDB, where the optimizer
+    rewrites it as a bbox-overlap IE join over the cached extents -- much
+    faster than pulling the points out and doing a GeoPandas sjoin.
 
-    # Open source Parquet file
-    src_ds = ogr.Open(parquet_file, 0)
-    if src_ds is None:
-        print("Could not open source dataset")
-        exit(1)
+    Args:
+    - points_table (str): DuckDB table of points (e.g. from read_points_from_parquet_file).
+    - grid (str or GeoDataFrame): Grid table name (e.g. from create_vector_grid_sql)
+      or a GeoDataFrame (e.g. from create_vector_grid).
+    - geom_col (str): The geometry column of the points table.
+    - out_table (str): Optional DuckDB table to materialize the result into.
 
-    # Get the source layer
-    src_layer = src_ds.GetLayer()
+    Returns:
+    - out_table if given, otherwise a DuckDB relation with the points plus a
+      cell_id column (call .df()/.arrow() on it as needed).
+    """
+    _check_identifier(points_table)
+    _check_identifier(geom_col)
+
+    if isinstance(grid, str):
+        _check_identifier(grid)
+        # Grid tables from create_vector_grid_sql store BOX_2D cells.
+        # 0-based cell_ids to match the GeoDataFrame branch below.
+        grid_rel = f'(SELECT row_number() OVER () - 1 AS cell_id, cell::GEOMETRY AS geom FROM {grid})'
+    else:
+        import pandas as pd
+        grid_df = pd.DataFrame({'cell_id': range(len(grid)),
+                                'wkb': grid.geometry.to_wkb()})
+        _CONN.register('_grid_cells', grid_df)
+        grid_rel = '(SELECT cell_id, ST_GeomFromWKB(wkb) AS geom FROM _grid_cells)'
+
+    join_query = f"""
+    SELECT p.*, g.cell_id
+    FROM {points_table} p
+    JOIN {grid_rel} g ON ST_Intersects(p.{geom_col}, g.geom)
+    """
 
-    #for f in src_layer:
-        #print(f.GetField('geom'))#, f.GetGeometryRef().ExportToWkt())
+    if out_table is not None:
+        _check_identifier(out_table)
+        _CONN.execute(f"CREATE TABLE {out_table} AS {join_query}")
+        logging.info(f"Assigned points from '{points_table}' to grid cells in '{out_table}'")
+        return out_table
 
-    # Create destination Parquet file
-    dest_driver = ogr.GetDriverByName("Parquet")
-    if dest_driver is None:
-        print("Parquet driver is not available")
-        exit(1)
+    return _CONN.sql(join_query)
 
-    dest_ds = dest_driver.CreateDataSource(gpq_file)
-    if dest_ds is None:
-        print("Could not create destination dataset")
-        exit(1)
+def validate_geoparquet_file(file_path):
+    """
+    Validates a GeoParquet file.
+    Requires the validate_geoparquet.py script to be in the same directory.
+    See https://gdal.org/drivers/vector/parquet.html#validation-script
+    and
+    https://github.com/OSGeo/gdal/blob/master/swig/python/gdal-utils/osgeo_utils/samples/validate_geoparquet.py
 
-    # Create destination layer
-    dest_layer = dest_ds.CreateLayer("layer_name", geom_type=ogr.wkbPoint, options=['GEOMETRY_NAME=geometry', 'COMPRESSION=SNAPPY']) #geom_type=src_layer.GetGeomType())
+    Calls the validator in-process rather than shelling out to a fresh
+    python3, which paid the interpreter + GDAL import cost on every file.
 
-    # Get a list of the fields in the source layer and add them to the destination layer
-    src_defn = src_layer.GetLayerDefn()
-    for i in range(src_defn.GetFieldCount()):
-        if src_defn.GetFieldDefn(i).GetName() == 'geometry':
-            continue
-        field_defn = src_defn.GetFieldDefn(i)
-        print(field_defn.GetName(), ":", field_defn.GetTypeName())
-        dest_layer.CreateField(field_defn)
+    Returns:
+    - A list of error messages, empty if the file is valid.
+    """
+    import validate_geoparquet
 
-    # Loop through features to copy them
-    src_feature = src_layer.GetNextFeature()
-    #print(src_feature)
+    errors = validate_geoparquet.check(file_path, check_data=True)
+    if errors:
+        for msg in errors:
+            logging.error(msg)
+    else:
+        logging.info(f"{file_path} is a valid GeoParquet file")
+    return errors
 
-    if max_rows is None:
-        limit = src_layer.GetFeatureCount()
+def local_MarCad_csv_to_parquet(file_path, wkb=True):
+    """
+    Converts a local MarCad CSV file to a local MarCad Parquet file.
+
+    By default the geometry is written as WKB, which is what
+    read_points_from_parquet_file expects. Pass wkb=False to write the
+    point as a plain {x, y} struct instead -- 16 raw bytes per row that
+    consumers can read without any WKB parsing.
+    """
+
+    csv = file_path
+    if wkb:
+        geometry_expr = "ST_AsWKB(ST_POINT(LON, LAT))"
     else:
-        limit = max_rows
-
-    count = 0
-    while src_feature and count < limit:
-        print(count, end='\r')
-        #print(src_feature.GetField('geometry'))
-        dest_feature = ogr.Feature(dest_layer.GetLayerDefn())
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint_2D(src_feature.GetField('LON'), src_feature.GetField('LAT')) # SHOULD BE ABLE TO USE EXISTING GEOM COLUMN??
-        #point.AddGeometry
-        #dest_feature.SetFrom(src_feature)
-        dest_feature.SetGeometry(point)
-        for i in range(src_feature.GetFieldCount()-1):
-            dest_feature.SetField(i, src_feature.GetField(i))
-
-        dest_layer.CreateFeature(dest_feature)
-        src_feature = src_layer.GetNextFeature()
-        #if max_rows is not None:
-        count += 1
-
-    # Close datasets
-    src_ds = None
-    dest_ds = None
\ No newline at end of file
+        geometry_expr = "{'x': LON, 'y': LAT}"
+    # read_csv_auto is parallel by default; the old parallel=false forced a
+    # single-threaded scan for no reason (row order doesn't matter here)
+    prq = os.path.splitext(csv)[0] + '.parquet'
+    _CONN.execute(f"""
+    COPY (SELECT *, {geometry_expr} AS geometry FROM read_csv_auto('{csv}'))
+    TO '{prq}' (FORMAT PARQUET)
+    """)
+    return prq
+
+def _geoparquet_geo_metadata(geometry_column='geometry'):
+    """
+    Builds the GeoParquet 'geo' footer metadata for a WKB point column.
+
+    No 'crs' key is written: the spec wants PROJJSON there, not an
+    authority string, and omitting it means OGC:CRS84 -- correct for
+    these lon/lat points.
+    """
+    return {
+        'version': '1.0.0',
+        'primary_column': geometry_column,
+        'columns': {
+            geometry_column: {
+                'encoding': 'WKB',
+                'geometry_types': ['Point'],
+            }
+        },
+    }
+
+def marCad_parquet_to_gpq(parquet_file, gpq_file, max_rows=None):
+    """
+    Converts a MarCad Parquet file to a GeoParquet file.
+
+    The old OGR version of this built one Feature and one Geometry object
+    per row and was too slow to be useful. This one streams Arrow record
+    batches straight from the source file and assembles the fixed 21-byte
+    point WKB with NumPy -- the 5-byte header is broadcast once and each
+    coordinate lands in the blob via a single vectorized copy per batch,
+    with no per-row Python work at all.
+    """
+    import json
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Little-endian byte order + geometry type 1 (Point)
+    wkb_point_header = np.frombuffer(b'\x01\x01\x00\x00\x00', dtype=np.uint8)
+
+    src = pq.ParquetFile(parquet_file)
+    fields = [f for f in src.schema_arrow if f.name != 'geometry']
+    schema = pa.schema(fields + [pa.field('geometry', pa.binary(21))])
+    schema = schema.with_metadata({b'geo': json.dumps(_geoparquet_geo_metadata()).encode()})
+
+    remaining = max_rows
+    with pq.ParquetWriter(gpq_file, schema, compression='snappy') as writer:
+        for batch in src.iter_batches(batch_size=65536):
+            if remaining is not None:
+                if remaining <= 0:
+                    break
+                batch = batch.slice(0, remaining)
+                remaining -= batch.num_rows
+
+            lon = batch.column('LON').to_numpy(zero_copy_only=False)
+            lat = batch.column('LAT').to_numpy(zero_copy_only=False)
+
+            wkb = np.empty((len(lon), 21), dtype=np.uint8)
+            wkb[:, :5] = wkb_point_header
+            wkb[:, 5:13].view(np.float64)[:, 0] = lon
+            wkb[:, 13:21].view(np.float64)[:, 0] = lat
+            geometry = pa.FixedSizeBinaryArray.from_buffers(
+                pa.binary(21), len(lon), [None, pa.py_buffer(wkb)])
+
+            columns = [batch.column(f.name) for f in fields] + [geometry]
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+
+    logging.info(f"Converted {parquet_file} to GeoParquet {gpq_file}")
\ No newline at end of file